@@ -1,12 +1,20 @@
 #!/usr/bin/python3
 # Copyright 2023 - 2024 Benjamin Steenkamer
+import base64
+import functools
+import hashlib
 import http.client
 import os
 import re
 import shutil
+import sys
+import threading
 import urllib.error
+import urllib.parse
 import urllib.request
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
 import cv2
 import numpy as np
 from tqdm import tqdm
@@ -22,101 +30,275 @@ HFQPDB = "https://www.hfqpdb.com"
 HFQPDB_RE = re.compile(r'\/coupons\/[^"]+')     # Coupons sometimes don't end with a file extension, so this matches to the end of <img src="">
 
 SAVE_DIR = "coupons/"
+DB_CACHE = "hfqpdb_cache.npz"   # HFQPDB coupons downloaded by previous runs; only coupons not in here are downloaded
+CACHE_VERSION = 1           # Bump whenever the hashes or vectors are computed differently, so old caches are ignored
+DOWNLOAD_THREADS = 64       # Downloads are network bound, so use more threads than the ThreadPoolExecutor default
 SIMILAR_THRESHOLD = 0.8     # How similar two images have to be to be considered the same
-
-
-def download_coupons(url, re_obj, desc, npos, replace="", replace_with=""):
+THUMB_SIZE = (256, 256)     # Coupons are shrunk to this size before being compared
+PHASH_SAME_DISTANCE = 6         # Perceptual hashes this many bits apart (or less) are the same coupon
+PHASH_DIFFERENT_DISTANCE = 16   # Perceptual hashes more than this many bits apart are different coupons; in between, fall back to cross-correlation
+
+HTTP_HEADERS = {"User-Agent": f"Python-urllib/{sys.version_info[0]}.{sys.version_info[1]}"}  # Same as urllib.request.urlopen()
+HTTP_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+Coupon = namedtuple("Coupon", ["image", "hash", "name", "vec", "phash", "url"])
+
+
+_connections = threading.local()    # Each thread keeps its own open connection per host, so TCP/TLS handshakes are reused
+
+
+def open_connection(parts):
+    """
+    Opens a connection to the host of a urlsplit() URL, through the same proxy urllib.request.urlopen() would use (http_proxy, https_proxy, no_proxy)
+    Returns the connection, extra request headers, and whether requests must use the absolute URL (plain HTTP through a proxy)
+    """
+    conn_type = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+    proxy = urllib.request.getproxies().get(parts.scheme)
+    if not proxy or urllib.request.proxy_bypass(parts.hostname):
+        return conn_type(parts.netloc, timeout=30), {}, False
+
+    proxy_parts = urllib.parse.urlsplit(proxy if "//" in proxy else f"http://{proxy}")
+    proxy_headers = {}
+    if proxy_parts.username:
+        credentials = f"{urllib.parse.unquote(proxy_parts.username)}:{urllib.parse.unquote(proxy_parts.password or '')}"
+        proxy_headers["Proxy-Authorization"] = f"Basic {base64.b64encode(credentials.encode()).decode()}"
+
+    conn = conn_type(proxy_parts.hostname, proxy_parts.port, timeout=30)
+    if parts.scheme == "https":     # TLS is tunneled through the proxy with CONNECT
+        conn.set_tunnel(parts.hostname, parts.port, headers=proxy_headers)
+        return conn, {}, False
+    return conn, proxy_headers, True
+
+
+def http_get(url, redirects=5):
+    """
+    Downloads url over a kept-alive connection, honoring the same proxy settings as urllib.request.urlopen()
+    Raises the same exceptions as urllib.request.urlopen() on failure
+    """
+    parts = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    if not hasattr(_connections, "by_host"):
+        _connections.by_host = {}
+    host = (parts.scheme, parts.netloc)
+
+    for attempt in range(2):    # The server may have closed an idle connection, so retry once on a fresh one
+        if host not in _connections.by_host:
+            _connections.by_host[host] = open_connection(parts)
+        conn, proxy_headers, absolute = _connections.by_host[host]
+        target = f"{parts.scheme}://{parts.netloc}{path}" if absolute else path
+        try:
+            conn.request("GET", target, headers={**HTTP_HEADERS, **proxy_headers})
+            response = conn.getresponse()
+            data = response.read()
+            break
+        except http.client.InvalidURL:
+            conn.close()    # The request was already started, so this connection can't send another one
+            del _connections.by_host[host]
+            raise
+        except (OSError, http.client.HTTPException) as e:
+            conn.close()
+            del _connections.by_host[host]
+            if attempt:
+                raise urllib.error.URLError(e) from e
+
+    if response.status in HTTP_REDIRECT_CODES:
+        if not redirects:   # Same as urlopen(), which gives up on redirect loops instead of returning the redirect page
+            raise urllib.error.HTTPError(url, response.status, f"Too many redirects; last was: {response.reason}", response.headers, None)
+        return http_get(urllib.parse.urljoin(url, response.getheader("Location")), redirects - 1)
+    if response.status >= 400:
+        raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+    return data
+
+
+def decode_grayscale(image_bytes):
+    """
+    Decodes image bytes straight into a half-size grayscale CV2 image; returns None if the bytes aren't an image
+    Only a THUMB_SIZE copy is kept, so there's no need to decode at full size or in color
+    """
+    return cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_2)
+
+
+def perceptual_hash(thumb):
+    """
+    64-bit DCT perceptual hash of a grayscale image; visually similar images have hashes with a small Hamming distance
+    """
+    small = cv2.resize(thumb, (32, 32), interpolation=cv2.INTER_AREA).astype(np.float32)
+    low_freq = cv2.dct(small)[:8, :8]   # Top-left of the DCT holds the lowest frequencies
+    bits = (low_freq > np.median(low_freq)).flatten()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def ncc_vector(thumb):
+    """
+    Mean-centered, unit-length copy of a thumbnail, flattened
+    The dot product of two of these is their normalized cross-correlation (cv2.TM_CCOEFF_NORMED for same-size images)
+    """
+    vec = thumb.astype(np.float32).ravel()
+    vec -= vec.mean()
+    norm = np.linalg.norm(vec)
+    return vec / norm if norm else vec  # A blank image has no variation; leave it all zeros
+
+
+def hamming_distances(phashes, phash):
+    """
+    Number of differing bits between each hash in the uint64 array phashes and phash
+    """
+    diff = np.bitwise_xor(phashes, np.uint64(phash))
+    return np.unpackbits(diff.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+def load_db_cache():
+    """
+    Returns the DB coupons saved by save_db_cache() as {url: Coupon}; their image bytes aren't saved
+    """
+    try:
+        with np.load(DB_CACHE) as cache:
+            if int(cache["version"]) != CACHE_VERSION:  # Fingerprints were computed differently
+                return {}
+            vecs = cache["vecs"]
+            if vecs.shape[1:] != (THUMB_SIZE[0] * THUMB_SIZE[1],):   # Saved with a different THUMB_SIZE
+                return {}
+            coupons = zip(cache["urls"].tolist(), cache["hashes"].tolist(), cache["names"].tolist(), vecs, cache["phashes"].tolist())
+            return {url: Coupon(None, image_hash, name, vec.astype(np.float32), phash, url) for url, image_hash, name, vec, phash in coupons}
+    except Exception:   # No cache yet, or it's unreadable (e.g. truncated: BadZipFile, zlib.error, EOFError); download everything again
+        return {}
+
+
+def save_db_cache(coupons, vecs):
+    """
+    Saves the DB coupons for load_db_cache(); vecs holds their ncc_vector()s, one per row
+    Written to a temporary file first, so an interrupted save never leaves a half-written cache behind
+    """
+    temp_path = f"{DB_CACHE}.tmp"
+    with open(temp_path, "wb") as fp:   # A file object, since savez_compressed() would append .npz to a path
+        np.savez_compressed(fp,
+                            version=np.array(CACHE_VERSION),
+                            urls=np.array([coupon.url for coupon in coupons], dtype=str),
+                            names=np.array([coupon.name for coupon in coupons], dtype=str),
+                            hashes=np.array([coupon.hash for coupon in coupons], dtype=np.uint64),
+                            phashes=np.array([coupon.phash for coupon in coupons], dtype=np.uint64),
+                            vecs=vecs.astype(np.float16))  # Half precision is plenty for a correlation threshold
+    os.replace(temp_path, DB_CACHE)
+
+
+def download_coupon(url):
+    last_slash = url.rfind("/") + 1
+    image_name = url[last_slash:]
+    try:
+        image_bytes = http_get(url)
+    except (urllib.error.URLError, http.client.InvalidURL):
+        # URLError = image doesn't actually exist on HF website
+        # InvalidURL = bugged file path on HF website
+        return Coupon(None, None, image_name, None, None, url)   # No hash marks a failed download
+
+    # Decode once here so later comparisons don't have to decode it again
+    gray = decode_grayscale(image_bytes)
+    if gray is None:    # Downloaded file isn't an image
+        return Coupon(None, None, image_name, None, None, url)
+    # Stable across runs, unlike the salted built-in hash()
+    image_hash = int.from_bytes(hashlib.blake2b(image_bytes, digest_size=8).digest(), "big")
+    thumb = cv2.resize(gray, THUMB_SIZE, interpolation=cv2.INTER_AREA)
+    return Coupon(image_bytes, image_hash, image_name, ncc_vector(thumb), perceptual_hash(thumb), url)
+
+
+def scrape_coupon_urls(url, re_obj, replace="", replace_with=""):
+    """
+    Finds the coupon image URLs on a web page
+    """
     coupon_urls = []
+    seen_urls = set()
     failed_urls = []
 
     try:
-        with urllib.request.urlopen(url) as web_page:
-            for line in web_page.readlines():
-                for coupon in re_obj.finditer(line.decode("unicode-escape")):
-                    c_url = coupon.group().replace(replace, replace_with)
-                    if c_url not in coupon_urls:    # Harbor Freight HTML can have duplicate URLs, so save once
-                        coupon_urls.append(c_url)
+        web_page = http_get(url).decode("unicode-escape")   # Decode the whole page at once rather than line by line
+        for coupon in re_obj.finditer(web_page):
+            c_url = coupon.group().replace(replace, replace_with)
+            if c_url not in seen_urls:  # Harbor Freight HTML can have duplicate URLs, so save once
+                seen_urls.add(c_url)
+                coupon_urls.append(c_url)
     except urllib.error.URLError:
         failed_urls.append(url)
 
-    def _thread(url):
-        last_slash = url.rfind("/") + 1
-        image_name = url[last_slash:]
-        try:
-            image_bytes = urllib.request.urlopen(url).read()
-            return image_bytes, hash(image_bytes), image_name, url
-        except (urllib.error.URLError, http.client.InvalidURL):
-            # URLError = image doesn't actually exist on HF website
-            # InvalidURL = bugged file path on HF website
-            return None, None, image_name, url
+    return url, coupon_urls, failed_urls
 
+
+def download_coupons(executor, url, coupon_urls, failed_urls, cache=None):
+    """
+    Queues the downloads of the coupon URLs found by scrape_coupon_urls() on executor
+    Coupons already in cache ({url: Coupon}) are reused instead of downloaded again
+    """
+    cache = cache or {}
+    cached_coupons = []
     requests = []
-    with ThreadPoolExecutor() as tpool:
-        for url in coupon_urls:
-            requests.append(tpool.submit(_thread, url))
+    for c_url in coupon_urls:
+        if c_url in cache:
+            cached_coupons.append(cache[c_url])
+        else:
+            requests.append(executor.submit(download_coupon, c_url))
+
+    return url, cached_coupons, requests, failed_urls
 
-    coupons = []
+
+def gather_coupons(url, cached_coupons, requests, failed_urls, desc, npos):
+    """
+    Waits for the downloads queued by download_coupons()
+    """
+    coupons = list(cached_coupons)
     if requests:
         pbar = tqdm(total=len(requests), position=npos, desc=desc)
         for request in as_completed(requests):  # yields futures as they complete
-            result = request.result()
-            if result[0] is not None:
-                coupons.append(result[:-1])
+            coupon = request.result()
+            if coupon.hash is not None:
+                coupons.append(coupon)
             else:
-                failed_urls.append(result[-1])
+                failed_urls.append(coupon.url)
             pbar.update(1)
-    elif not failed_urls:   # Only prints if no failed URLs and no coupon downloaded
+    elif not failed_urls and not coupons:   # Only prints if no failed URLs and no coupon downloaded or cached
         print("No coupons found    :", url)
 
     return coupons, failed_urls
 
 
-def coupons_are_similar(coupon_a, coupon_b):
-    def template_cmp(image, template_image):
-        """
-        Slides template_image over image, checking for similarities; template_image must not be greater than the image dimensions
-        """
-        try:
-            res = cv2.matchTemplate(image, template_image, cv2.TM_CCOEFF_NORMED)
-            if np.where(res >= SIMILAR_THRESHOLD)[0].size > 0:   # If there are similarities greater than threshold, they are probably the same coupon
-                return True
-            return False
-        except cv2.error:   # Happens when the template is larger than input image
-            return None
-
-    nparr_a = np.frombuffer(coupon_a, np.uint8) # Convert binary string to ndarray
-    nparr_b = np.frombuffer(coupon_b, np.uint8)
-
-    img_a = cv2.imdecode(nparr_a, cv2.IMREAD_COLOR)  # Convert ndarray to CV2 image
-    img_b = cv2.imdecode(nparr_b, cv2.IMREAD_COLOR)
+def coupons_are_similar(coupon_vecs, coupon_vec, candidates):
+    """
+    Compares one coupon's ncc_vector() against every row of coupon_vecs in a single matrix-vector product
+    Only the scores of rows selected by the boolean mask candidates count; masking the scores avoids copying the matrix rows
+    Same result as template matching the thumbnails pair by pair
+    """
+    if not candidates.any():    # Every coupon is clearly different by phash; skip the matrix product
+        return False
+    scores = coupon_vecs @ coupon_vec
+    return bool((scores[candidates] >= SIMILAR_THRESHOLD).any())    # If a correlation is greater than threshold, they are probably the same coupon
 
-    coupon_a_gray = cv2.cvtColor(img_a, cv2.COLOR_BGR2GRAY) # Convert to grayscale
-    coupon_b_gray = cv2.cvtColor(img_b, cv2.COLOR_BGR2GRAY)
 
-    # Try to use coupon A as input, coupon b as the template
-    # If that fails, switch the two around and try again
-    are_similar = template_cmp(coupon_a_gray, coupon_b_gray)
-    if are_similar is None:
-         are_similar = template_cmp(coupon_b_gray, coupon_a_gray)
+@functools.cache
+def make_save_dir():
+    """
+    Creates SAVE_DIR the first time a coupon is saved; later calls do nothing
+    """
+    os.makedirs(SAVE_DIR, exist_ok=True)
 
-    return are_similar if are_similar is not None else False
 
-
-def process_coupon(hf_coupon, database):
+def process_coupon(hf_coupon, db_hashes, db_phashes, db_vecs):
     not_found = None
-    hf_image, hf_image_hash, hf_name = hf_coupon
 
-    if hf_image_hash is not None:
+    if hf_coupon.hash is not None:
         save = True
-        for db_image, db_image_hash, _db_name in database:
-            if hf_image_hash == db_image_hash or coupons_are_similar(db_image, hf_image): # Coupon images are exactly the same (hash) or are fairly similar (CV template match)
+        if hf_coupon.hash in db_hashes: # Coupon images are exactly the same (hash)
+            save = False
+        else:
+            distances = hamming_distances(db_phashes, hf_coupon.phash)   # Compare against every DB coupon at once
+            if (distances <= PHASH_SAME_DISTANCE).any():    # Coupon images are perceptually the same (phash)
                 save = False
-                break
+            else:
+                # Only cross-correlate with DB coupons whose perceptual hashes are neither clearly the same nor clearly different
+                candidates = distances <= PHASH_DIFFERENT_DISTANCE
+                if coupons_are_similar(db_vecs, hf_coupon.vec, candidates):   # Coupon images are fairly similar (cross-correlation)
+                    save = False
         if save:
-            os.makedirs(SAVE_DIR, exist_ok=True)
-            not_found = hf_name
-            with open(f"{SAVE_DIR}{hf_name}", "wb") as fp:
-                fp.write(hf_image)
+            make_save_dir()
+            not_found = hf_coupon.name
+            Path(SAVE_DIR, hf_coupon.name).write_bytes(hf_coupon.image)
 
     return not_found
 
@@ -129,22 +311,42 @@ if __name__ == "__main__":
     if os.path.exists(SAVE_DIR):
         shutil.rmtree(SAVE_DIR)
 
-    p_executor = ProcessPoolExecutor()
+    t_executor = ThreadPoolExecutor(max_workers=DOWNLOAD_THREADS)   # All downloads share one pool (and its kept-alive connections)
 
-    # Download coupons from HF and DB
-    db_requests = p_executor.submit(download_coupons, *(f"{HFQPDB}/browse", HFQPDB_RE, "Downloading HFQPDB  ", 0, "/coupons/thumbs/tn_", f"{HFQPDB}/coupons/"))
-    main_requests= p_executor.submit(download_coupons, *(HF, HF_RE, "Downloading HF      ", 1))
-    promo_request = p_executor.submit(download_coupons, *(HF_PROMO, HF_PROMO_RE, "Downloading HF Promo", 2))
+    # Fetch the HF and DB pages at the same time
+    db_page = t_executor.submit(scrape_coupon_urls, f"{HFQPDB}/browse", HFQPDB_RE, "/coupons/thumbs/tn_", f"{HFQPDB}/coupons/")
+    main_page = t_executor.submit(scrape_coupon_urls, HF, HF_RE)
+    promo_page = t_executor.submit(scrape_coupon_urls, HF_PROMO, HF_PROMO_RE)
+    db_cache = load_db_cache()
 
-    # Gather downloaded coupons
-    db_coupons = db_requests.result()[0]
-    hf_coupons = main_requests.result()[0] + promo_request.result()[0]
-    failed_urls = db_requests.result()[1] + main_requests.result()[1] + promo_request.result()[1]
+    # Download coupons from HF and DB; each page's downloads start as soon as that page is scraped, while the others are still loading
+    requests = {}
+    for page in as_completed([db_page, main_page, promo_page]):
+        requests[page] = download_coupons(t_executor, *page.result(), db_cache if page is db_page else None)
 
-    # Process coupons
+    # Gather downloaded coupons
+    db_coupons, db_failed = gather_coupons(*requests[db_page], "Downloading HFQPDB  ", 0)
+    main_coupons, main_failed = gather_coupons(*requests[main_page], "Downloading HF      ", 1)
+    promo_coupons, promo_failed = gather_coupons(*requests[promo_page], "Downloading HF Promo", 2)
+    t_executor.shutdown()
+    del requests, db_cache  # Release the futures and cache, which also reference the downloaded coupons
+
+    hf_coupons = main_coupons + promo_coupons
+    failed_urls = db_failed + main_failed + promo_failed
+    db_hashes = {coupon.hash for coupon in db_coupons}
+    db_phashes = np.array([coupon.phash for coupon in db_coupons], dtype=np.uint64)
+    db_vecs = np.empty((len(db_coupons), THUMB_SIZE[0] * THUMB_SIZE[1]), dtype=np.float32)   # One ncc_vector() per row
+    for i, coupon in enumerate(db_coupons):
+        db_vecs[i] = coupon.vec
+        db_coupons[i] = coupon._replace(vec=None)   # db_vecs keeps the only copy, so DB memory isn't doubled
+    if db_coupons:  # Don't wipe out the cache if the DB couldn't be reached
+        save_db_cache(db_coupons, db_vecs)  # Coupons no longer on the DB browse page drop out of the cache
+
+    # Process coupons; threads are enough since numpy releases the GIL, and they share the DB arrays instead of pickling them to processes
+    process_executor = ThreadPoolExecutor()
     process_reqs = []
     for hf_coupon in hf_coupons:
-        process_reqs.append(p_executor.submit(process_coupon, hf_coupon, db_coupons))
+        process_reqs.append(process_executor.submit(process_coupon, hf_coupon, db_hashes, db_phashes, db_vecs))
 
     # Gather processed coupon results
     not_found = []